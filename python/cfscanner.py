@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 
+import contextlib
+import csv
+import io
 import multiprocessing
 import os
 import signal
-import statistics
+import sys
 from datetime import datetime
-from functools import partial
 
+import numpy as np
 from args.parser import parse_args
 from args.testconfig import TestConfig
 from rich import print as rprint
@@ -26,9 +29,27 @@ def _prescan_sigint_handler(sig, frame):
     console.log(
         "[yellow]KeyboardInterrupt detected (pre-scan phase)[/yellow]")
     exit(1)
-    
-def _init_pool():
+
+
+# per-worker scan state, set once by the pool initializer so it does not
+# have to be pickled along with every task
+_worker_test_config = None
+_worker_config_dir = None
+
+
+def _init_pool(test_config, config_dir):
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global _worker_test_config, _worker_config_dir
+    _worker_test_config = test_config
+    _worker_config_dir = config_dir
+
+
+def _test_ip_worker(ip_cidr):
+    return test_ip(
+        ip_cidr,
+        test_config=_worker_test_config,
+        config_dir=_worker_config_dir
+    )
 
 
 SCRIPTDIR = os.path.dirname(os.path.realpath(__file__))
@@ -76,23 +97,21 @@ if __name__ == "__main__":
     # create empty result file
     with console.status(f"[green]Creating empty result file {INTERIM_RESULTS_PATH}[/green]"):
         try:
-            with open(INTERIM_RESULTS_PATH, "w") as empty_file:
+            with open(INTERIM_RESULTS_PATH, "w", newline="") as empty_file:
                 titles = [
                     "ip", "avg_download_speed", "avg_upload_speed",
                     "avg_download_latency", "avg_upload_latency",
                     "avg_download_jitter", "avg_upload_jitter"
                 ]
                 titles += [
-                    f"download_speed_{i+1}" for i in range(args.n_tries)
+                    f"{metric}_{i + 1}"
+                    for metric in (
+                        "download_speed", "upload_speed",
+                        "download_latency", "upload_latency"
+                    )
+                    for i in range(args.n_tries)
                 ]
-                titles += [f"upload_speed_{i+1}" for i in range(args.n_tries)]
-                titles += [
-                    f"download_latency_{i+1}" for i in range(args.n_tries)
-                ]
-                titles += [
-                    f"upload_latency_{i+1}" for i in range(args.n_tries)
-                ]
-                empty_file.write(",".join(titles) + "\n")
+                csv.writer(empty_file).writerow(titles)
         except Exception as e:
             console.log(
                 f"[red]Could not create empty result file:\n\"{INTERIM_RESULTS_PATH}\"[/red]"
@@ -148,60 +167,149 @@ if __name__ == "__main__":
         console.print_exception()
         exit(1)
 
-    n_total_ips = sum(get_num_ips_in_cidr(
-        cidr,
-        sample_size=test_config.sample_size
-    ) for cidr in cidr_list)
-    console.log(f"[blue]Starting to scan {n_total_ips} ips...[/blue]")
+    # filled in by gen_ips as each cidr is expanded, so the counts always
+    # match the ip lists actually fed to the workers; a cidr's count is
+    # recorded before any of its ips is dispatched, hence before any of its
+    # results can arrive
+    cidr_num_ips = {}
 
-    cidr_ip_lists = [
-        cidr_to_ip_list(
-            cidr,
-            sample_size=test_config.sample_size)
+    def gen_ips():
+        """yields (ip, cidr) tuples one cidr at a time so the full ip list
+        never has to be materialized in memory
+        """
+        for cidr in cidr_list:
+            ip_list = cidr_to_ip_list(
+                cidr, sample_size=test_config.sample_size)
+            cidr_num_ips[cidr] = len(ip_list)
+            for ip in ip_list:
+                yield ip, cidr
+
+    # the grand total is the one count that is needed before the generator
+    # runs, so it is derived arithmetically from the cidrs
+    n_total_ips = sum(
+        get_num_ips_in_cidr(cidr, sample_size=test_config.sample_size)
         for cidr in cidr_list
-    ]
-    big_ip_list = [(ip, cidr) for cidr, ip_list in zip(
-        cidr_list, cidr_ip_lists) for ip in ip_list]
+    )
+    console.log(f"[blue]Starting to scan {n_total_ips} ips...[/blue]")
 
-    cidr_scanned_ips = {cidr: 0 for cidr in cidr_list}
+    # upload stats are only meaningful when the upload test ran; pick the
+    # stat functions once instead of re-checking the flag on every result
+    if test_config.do_upload_test:
+        def upload_mean(samples): return float(samples.mean())
+        upload_jitter = mean_jitter
+    else:
+        def upload_mean(samples): return -1
+        upload_jitter = upload_mean
+
+    # countdown of ips left per cidr, seeded from cidr_num_ips when a cidr's
+    # first result arrives; a cidr is finished when it hits zero
+    cidr_remaining_ips = {}
 
     cidr_prog_tasks = dict()
 
-    with Progress() as progress:
+    # keep a single buffered handle open for the whole scan instead of
+    # reopening the result file for every row; rows are staged in an
+    # in-memory buffer and written out in batches to coalesce syscalls
+    results_file = open(
+        INTERIM_RESULTS_PATH, "a",
+        buffering=1 << 16, newline=""
+    )
+    row_buffer = io.StringIO()
+    results_writer = csv.writer(row_buffer)
+    n_buffered_rows = 0
+
+    def flush_results():
+        """drains buffered result rows to disk so partial results survive
+        interrupts and crashes
+        """
+        global n_buffered_rows
+        data = row_buffer.getvalue()
+        if data:
+            results_file.write(data)
+            results_file.flush()
+            row_buffer.seek(0)
+            row_buffer.truncate(0)
+        n_buffered_rows = 0
+
+    with results_file, Progress() as progress:
         all_ips_task = progress.add_task(
             f"all subnets - {n_total_ips} ips", total=n_total_ips)
-        with multiprocessing.Pool(processes=threadsCount, initializer=_init_pool) as pool:
+        if threadsCount <= 1:
+            # a single worker gains nothing from a pool; run the tests
+            # inline and skip fork, pickling and pipe IPC entirely
+            pool_context = contextlib.nullcontext()
+        else:
+            # fork workers on Linux so they inherit the already-imported
+            # modules via copy-on-write instead of reimporting everything;
+            # macOS and Windows keep their platform default, since forking
+            # after threads exist (rich's refresh thread is running by now)
+            # can crash macOS system frameworks
+            if sys.platform.startswith("linux"):
+                mp_context = multiprocessing.get_context("fork")
+            else:
+                mp_context = multiprocessing.get_context()
+            pool_context = mp_context.Pool(
+                processes=threadsCount,
+                initializer=_init_pool,
+                initargs=(test_config, CONFIGDIR),
+                maxtasksperchild=64
+            )
+        with pool_context as pool:
             signal.signal(signal.SIGINT, original_sigint_handler)
-            iterator = pool.imap(
-                partial(test_ip, test_config=test_config, config_dir=CONFIGDIR), big_ip_list)
-            while True:
-                try:
-                    res = next(iterator)
-                    progress.update(all_ips_task, advance=1)
-                    if cidr_scanned_ips[res.cidr] == 0:
-                        n_ips_cidr = get_num_ips_in_cidr(
-                            res.cidr, sample_size=test_config.sample_size)
-                        cidr_prog_tasks[res.cidr] = progress.add_task(
-                            f"{res.cidr} - {n_ips_cidr} ips", total=n_ips_cidr)
-                    progress.update(cidr_prog_tasks[res.cidr], advance=1)
-
-                    if res.is_ok:
-                        down_mean_jitter = mean_jitter(
-                            res.result["download"]["latency"])
-                        up_mean_jitter = mean_jitter(
-                            res.result["upload"]["latency"]) if test_config.do_upload_test else -1
-                        mean_down_speed = statistics.mean(
-                            res.result["download"]["speed"])
-                        mean_up_speed = statistics.mean(
-                            res.result["upload"]["speed"]) if test_config.do_upload_test else -1
-                        mean_down_latency = statistics.mean(
-                            res.result["download"]["latency"])
-                        mean_up_latency = statistics.mean(
-                            res.result["upload"]["latency"]) if test_config.do_upload_test else -1
-
-                        rprint(res.message)
-
-                        with open(INTERIM_RESULTS_PATH, "a") as outfile:
+            if pool is None:
+                # set the scan state the same way the pool initializer would
+                # (minus the SIGINT masking) and reuse the worker function
+                _worker_test_config = test_config
+                _worker_config_dir = CONFIGDIR
+                iterator = map(_test_ip_worker, gen_ips())
+            else:
+                # send ips to the workers in chunks to amortize the pickling
+                # and pipe round-trip cost over many tasks; order does not
+                # matter since results carry their own ip and cidr. the cap
+                # keeps chunks small because a worker only delivers results
+                # once it finishes its whole chunk, and each task is a
+                # multi-second speed test
+                chunksize = min(16, max(1, n_total_ips // (threadsCount * 4)))
+                iterator = pool.imap_unordered(
+                    _test_ip_worker,
+                    gen_ips(),
+                    chunksize=chunksize
+                )
+            # advances for the all-subnets bar are accumulated and flushed in
+            # batches so rich is not asked to re-render on every single ip
+            pending_advance = 0
+            try:
+                for res in iterator:
+                    try:
+                        pending_advance += 1
+                        if res.cidr not in cidr_prog_tasks:
+                            n_ips_cidr = cidr_num_ips[res.cidr]
+                            cidr_remaining_ips[res.cidr] = n_ips_cidr
+                            cidr_prog_tasks[res.cidr] = progress.add_task(
+                                f"{res.cidr} - {n_ips_cidr} ips", total=n_ips_cidr)
+                        progress.update(cidr_prog_tasks[res.cidr], advance=1)
+
+                        if res.is_ok:
+                            # zero-copy views over the double arrays built by
+                            # test_ip, reused for both the mean and the jitter
+                            down_latencies = np.frombuffer(
+                                res.result["download"]["latency"], dtype=np.float64)
+                            up_latencies = np.frombuffer(
+                                res.result["upload"]["latency"], dtype=np.float64)
+                            down_speeds = np.frombuffer(
+                                res.result["download"]["speed"], dtype=np.float64)
+                            up_speeds = np.frombuffer(
+                                res.result["upload"]["speed"], dtype=np.float64)
+
+                            down_mean_jitter = mean_jitter(down_latencies)
+                            up_mean_jitter = upload_jitter(up_latencies)
+                            mean_down_speed = float(down_speeds.mean())
+                            mean_up_speed = upload_mean(up_speeds)
+                            mean_down_latency = float(down_latencies.mean())
+                            mean_up_latency = upload_mean(up_latencies)
+
+                            rprint(res.message)
+
                             res_parts = [
                                 res.ip, mean_down_speed, mean_up_speed,
                                 mean_down_latency, mean_up_latency,
@@ -212,36 +320,57 @@ if __name__ == "__main__":
                             res_parts += res.result["download"]["latency"]
                             res_parts += res.result["upload"]["latency"]
 
-                            outfile.write(",".join(map(str, res_parts)) + "\n")
-                    else:
-                        rprint(res.message)
+                            results_writer.writerow(res_parts)
+                            n_buffered_rows += 1
+                        else:
+                            rprint(res.message)
 
-                    cidr_scanned_ips[res.cidr] += 1
-                    if cidr_scanned_ips[res.cidr] == get_num_ips_in_cidr(res.cidr, sample_size=test_config.sample_size):
-                        progress.remove_task(cidr_prog_tasks[res.cidr])
-                except StartProxyServiceError as e:
-                    progress.stop()
-                    console.log(f"[red]{e}[/red]")
+                        cidr_remaining_ips[res.cidr] -= 1
+                        cidr_finished = cidr_remaining_ips[res.cidr] == 0
+                        if cidr_finished:
+                            progress.remove_task(cidr_prog_tasks[res.cidr])
+                        if pending_advance >= 32 or cidr_finished:
+                            progress.update(
+                                all_ips_task, advance=pending_advance)
+                            pending_advance = 0
+                        if n_buffered_rows >= 256 or cidr_finished:
+                            flush_results()
+                    except Exception as e:
+                        progress.log("[red]Unknown error![/red]")
+                        console.print_exception()
+                        logging.exception(e)
+                if pending_advance:
+                    progress.update(all_ips_task, advance=pending_advance)
+                for task in progress.tasks:
+                    progress.stop_task(task.id)
+                    progress.remove_task(task.id)
+                progress.stop()
+                progress.log("Finished scanning ips.")
+            except StartProxyServiceError as e:
+                progress.stop()
+                console.log(f"[red]{e}[/red]")
+                if pool is not None:
+                    pool.terminate()
+                logging.exception("Error in starting xray service.")
+            except KeyboardInterrupt:
+                for task_id in progress.task_ids:
+                    progress.stop_task(task_id)
+                    progress.remove_task(task_id)
+                progress.stop()
+                progress.log(
+                    "[yellow]KeyboardInterrupt detected (scan phase)[/yellow]")
+                if pool is not None:
                     pool.terminate()
-                    logging.exception("Error in starting xray service.")
-                    break
-                except StopIteration as e:
-                    for task in progress.tasks:
-                        progress.stop_task(task.id)
-                        progress.remove_task(task.id)
-                    progress.stop()
-                    progress.log("Finished scanning ips.")
-                    break
-                except KeyboardInterrupt as e:
-                    for task_id in progress.task_ids:
-                        progress.stop_task(task_id)
-                        progress.remove_task(task_id)
-                    progress.stop()
-                    progress.log(
-                        "[yellow]KeyboardInterrupt detected (scan phase)[/yellow]")
+            except Exception as e:
+                # errors raised by the iterator itself (pool failures, bad
+                # cidrs expanded lazily by gen_ips) cannot be recovered
+                # per-result; log them and stop cleanly
+                progress.stop()
+                progress.log("[red]Unknown error![/red]")
+                console.print_exception()
+                logging.exception(e)
+                if pool is not None:
                     pool.terminate()
-                    break
-                except Exception as e:
-                    progress.log("[red]Unknown error![/red]")
-                    console.print_exception()
-                    logging.exception(e)
+            finally:
+                # no matter how the scan ends, buffered rows go to disk
+                flush_results()
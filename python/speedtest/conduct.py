@@ -1,3 +1,5 @@
+import array
+
 import requests
 
 from args.testconfig import TestConfig
@@ -29,16 +31,19 @@ class TestResult:
         self.n_tries = n_tries
         self.message = ""
 
+        # compact double arrays instead of lists of boxed floats; they
+        # support indexing and iteration like lists and convert to numpy
+        # without a copy
         self.result = dict(
             ip=ip,
             success=False,
             download=dict(
-                speed=[-1] * self.n_tries,
-                latency=[-1] * self.n_tries
+                speed=array.array("d", [-1] * self.n_tries),
+                latency=array.array("d", [-1] * self.n_tries)
             ),
             upload=dict(
-                speed=[-1] * self.n_tries,
-                latency=[-1] * self.n_tries
+                speed=array.array("d", [-1] * self.n_tries),
+                latency=array.array("d", [-1] * self.n_tries)
             )
         )
 
@@ -1,16 +1,16 @@
-import statistics
+import numpy as np
 
 
-def mean_jitter(latencies: list) -> float:
+def mean_jitter(latencies) -> float:
     """calculates the mean jitter of a list of latencies
 
     Args:
-        latencies (list): the list of latencies
+        latencies (list): the list (or array) of latencies
 
     Returns:
         float: the mean jitter
     """
-    if len(latencies) <= 1:
+    latencies = np.asarray(latencies, dtype=np.float64)
+    if latencies.size <= 1:
         return -1
-    jitters = [abs(a - b) for a, b in zip(latencies[1:], latencies[:-1])]
-    return statistics.mean(jitters)
+    return float(np.abs(np.diff(latencies)).mean())
@@ -6,6 +6,7 @@ import re
 from typing import Union
 from urllib.parse import urlparse
 
+import numpy as np
 import requests
 from rich.console import Console
 from utils.exceptions import *
@@ -27,15 +28,37 @@ def cidr_to_ip_list(
     Returns:
         list: a list of ips associated with the subnet
     """
-    ip_list = list(map(str, ipaddress.ip_network(cidr, strict=False)))
-    if sample_size is None or sample_size >= len(ip_list):
-        return ip_list
-    elif 1 <= sample_size < len(ip_list):
-        return random.sample(ip_list, round(sample_size))
-    elif 0 < sample_size < 1:
-        return random.sample(ip_list, math.ceil(len(ip_list) * sample_size))
-    else:
-        raise ValueError(f"Invalid sample size: {sample_size}")
+    network = ipaddress.ip_network(cidr, strict=False)
+    if network.version != 4:
+        # uint32 arithmetic below only covers IPv4
+        ip_list = list(map(str, network))
+        if sample_size is None or sample_size >= len(ip_list):
+            return ip_list
+        elif 1 <= sample_size < len(ip_list):
+            return random.sample(ip_list, round(sample_size))
+        elif 0 < sample_size < 1:
+            return random.sample(ip_list, math.ceil(len(ip_list) * sample_size))
+        else:
+            raise ValueError(f"Invalid sample size: {sample_size}")
+
+    n_ips = network.num_addresses
+    ints = np.uint32(int(network.network_address)) + \
+        np.arange(n_ips, dtype=np.uint32)
+    if sample_size is not None and sample_size < n_ips:
+        if sample_size >= 1:
+            ints = np.random.choice(ints, round(sample_size), replace=False)
+        elif 0 < sample_size < 1:
+            ints = np.random.choice(
+                ints, math.ceil(n_ips * sample_size), replace=False)
+        else:
+            raise ValueError(f"Invalid sample size: {sample_size}")
+    octets = np.stack([
+        (ints >> 24) & 0xff,
+        (ints >> 16) & 0xff,
+        (ints >> 8) & 0xff,
+        ints & 0xff
+    ])
+    return ["%d.%d.%d.%d" % tuple(ip_octets) for ip_octets in octets.T]
 
 
 def get_num_ips_in_cidr(